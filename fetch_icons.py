@@ -8,53 +8,93 @@ fetch_icons.py
 - Поддерживает и сохраняет русские (и любые юникодные) названия файлов, когда это возможно.
 - Если файловая система не позволяет создать файл с таким именем, делается безопасный fallback-имя (ASCII).
 - Делает резервную копию исходного JSON перед перезаписью.
-- Параллельная загрузка через ThreadPoolExecutor.
+- Асинхронная параллельная загрузка через asyncio + aiohttp (один event loop, без пула потоков).
+- Одинаковые URL иконок скачиваются один раз; в outdir/.cache.json хранится кэш
+  (ETag / Last-Modified), при повторном запуске неизменившиеся иконки не перекачиваются (HTTP 304).
+- Иконки в виде data:-URI (data:image/png;base64,...) декодируются и сохраняются без сетевых запросов.
+- Сохраняет только картинки (Content-Type image/*) размером до 1 МиБ.
 - При ошибке скачивания оставляет оригинальный URL в поле `icon` (не затирает).
-- Записывает JSON с ensure_ascii=False (чтобы русские заголовки остались в файле).
+- Читает и записывает JSON через orjson; юникод пишется как есть (русские заголовки остаются читаемыми).
 
 Пример:
     uv run fetch_icons.py --input bookmarks.json --outdir /home/New_tab/icons/
 
 Зависимости:
-    uv add requests tqdm
+    uv add aiohttp orjson tqdm
 
 """
 
 from __future__ import annotations
 import argparse
-import json
+import asyncio
+import base64
+import functools
+import itertools
 import os
+import queue
 import re
 import shutil
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from collections import defaultdict
 from pathlib import Path
-from typing import Tuple
-from urllib.parse import unquote, urlparse
+from typing import Dict, List, Set, Tuple, Union
+from urllib.parse import unquote, unquote_to_bytes, urlparse
 
-import requests
+import aiohttp
+import orjson
 from tqdm import tqdm
 import mimetypes
 
+# загружаем таблицы mimetypes один раз при импорте, а не лениво при первом guess_type
+mimetypes.init()
+
 # ---------- Конфигурация ----------
 DEFAULT_TIMEOUT = 8  # секунд на HTTP запрос
-MAX_WORKERS = 8      # число concurrent загрузок (можно уменьшить)
+MAX_WORKERS = 32     # число одновременных загрузок (можно уменьшить)
+MAX_PER_HOST = 4     # одновременных загрузок с одного хоста (защита от 429)
+DNS_CACHE_TTL = 300  # секунд кэширования DNS-ответов в коннекторе
+USER_AGENT = 'Mozilla/5.0 (compatible; fetch-icons/1.0)'  # заголовок User-Agent для всех запросов
+KEEPALIVE_TIMEOUT = 30  # секунд держать простаивающее keep-alive соединение
+# orjson: отступ 2 пробела; юникод (русские заголовки) пишется как есть, в UTF-8
+JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+CACHE_FILENAME = '.cache.json'  # кэш icon_url -> (файл, ETag, Last-Modified) в outdir
+MAX_ICON_BYTES = 1024 * 1024    # иконки больше этого размера не сохраняются
+ICON_BUF_SIZE = 64 * 1024       # начальный размер буфера под тело иконки
+MAX_POOLED_BUF = 4 * ICON_BUF_SIZE  # буферы крупнее этого не возвращаются в пул (редкие большие тела)
 # ----------------------------------
 
-# Content-Type -> расширение
+# Content-Type (без параметров вроде "; charset=...") -> расширение
 CONTENT_TYPE_EXT = {
     'image/png': '.png',
     'image/x-icon': '.ico',
     'image/vnd.microsoft.icon': '.ico',
-    'image/vnd.microsoft.icon; charset=binary': '.ico',
     'image/jpeg': '.jpg',
     'image/jpg': '.jpg',
     'image/svg+xml': '.svg',
     'image/webp': '.webp',
     'image/gif': '.gif',
-    'image/vnd.microsoft.icon; charset=utf-8': '.ico',
 }
 
+# Content-Type, с которыми серверы нередко отдают настоящие иконки: их не отбрасываем
+GENERIC_CONTENT_TYPES = frozenset({'', 'application/octet-stream', 'binary/octet-stream'})
+
+# Схемы icon, которые нужно обрабатывать; всё остальное считается уже локальным путём
+REMOTE_ICON_PREFIXES = ('http://', 'https://', 'data:')
+
+# Задача на загрузку: (индекс в JSON, title, url, icon_url) — строки уже очищены strip()
+IconTask = Tuple[int, str, str, str]
+
+# Регулярные выражения для очистки имён файлов (компилируются один раз)
+_WS_RE = re.compile(r'\s+')
+_BAD_RE = re.compile(r'[^\w\-\._]')
+_ASCII_BAD_RE = re.compile(r'[^A-Za-z0-9\-\._]')
+
+# Пул переиспользуемых буферов под тела ответов. Одновременно занято не больше
+# буферов, чем активных загрузок (их ограничивает семафор), поэтому пул
+# сам по себе не разрастается сверх --workers.
+_BUF_POOL: queue.LifoQueue = queue.LifoQueue()
+
 
 def safe_filename_unicode(name: str, max_len: int = 120) -> str:
     """
@@ -67,11 +107,11 @@ def safe_filename_unicode(name: str, max_len: int = 120) -> str:
     # удалим путь и лишние пробелы
     name = name.replace('/', '_').replace('\\', '_')
     # заменим последовательности пробельных символов
-    name = re.sub(r'\s+', '_', name)
+    name = _WS_RE.sub('_', name)
     # Разрешаем unicode-слова (\w в Python поддерживает юникод), плюс точки, дефисы и подчёркивания
     # Удаляем всё, что не является словом или .-_
     # Флаг re.UNICODE по умолчанию активен в Python3
-    name = re.sub(r'[^\w\-\._]', '', name)
+    name = _BAD_RE.sub('', name)
     # Обрежем до max_len
     if len(name) > max_len:
         name = name[:max_len]
@@ -88,7 +128,7 @@ def ascii_fallback_name(name: str, max_len: int = 80) -> str:
     """
     try:
         ascii_name = name.encode('ascii', errors='ignore').decode('ascii')
-        ascii_name = re.sub(r'[^A-Za-z0-9\-\._]', '', ascii_name)
+        ascii_name = _ASCII_BAD_RE.sub('', ascii_name)
         ascii_name = ascii_name.strip() or 'file'
         if len(ascii_name) > max_len:
             ascii_name = ascii_name[:max_len]
@@ -97,21 +137,39 @@ def ascii_fallback_name(name: str, max_len: int = 80) -> str:
         return 'file'
 
 
+def url_host(url: str) -> str:
+    """Хост из URL или '', если URL не разбирается (например, битый IPv6 "http://[::1")."""
+    try:
+        return urlparse(url).hostname or ''
+    except ValueError:
+        return ''
+
+
+def content_type(resp: aiohttp.ClientResponse) -> str:
+    """Возвращает Content-Type ответа без параметров, в нижнем регистре."""
+    return resp.headers.get('Content-Type', '').partition(';')[0].strip().lower()
+
+
+@functools.lru_cache(maxsize=4096)
 def ext_from_url(url: str) -> str:
-    """Попытка взять расширение из URL-пути."""
+    """Попытка взять расширение из URL-пути (результат кэшируется)."""
     try:
-        p = urlparse(url).path
-        _, ext = os.path.splitext(p)
-        return ext.lower()
+        return os.path.splitext(urlparse(url).path)[1].lower()
     except Exception:
         return ''
 
 
-def choose_extension(resp: requests.Response, url: str) -> str:
+@functools.lru_cache(maxsize=4096)
+def guess_mime(url: str) -> str:
+    """mimetypes.guess_type(url)[0] с кэшем (пустая строка, если тип не угадан)."""
+    return mimetypes.guess_type(url)[0] or ''
+
+
+def choose_extension(ct: str, url: str) -> str:
     """
-    Определяем расширение файла по Content-Type, затем по URL, иначе .png.
+    Определяем расширение файла по Content-Type (уже нормализованному, см. content_type),
+    затем по URL, иначе .png.
     """
-    ct = resp.headers.get('Content-Type', '').split(';')[0].strip().lower()
     if ct in CONTENT_TYPE_EXT:
         return CONTENT_TYPE_EXT[ct]
     # по URL
@@ -119,80 +177,326 @@ def choose_extension(resp: requests.Response, url: str) -> str:
     if ext and len(ext) <= 5:
         return ext
     # по mime
-    guessed, _ = mimetypes.guess_type(url)
-    if guessed and guessed in CONTENT_TYPE_EXT:
+    guessed = guess_mime(url)
+    if guessed in CONTENT_TYPE_EXT:
         return CONTENT_TYPE_EXT[guessed]
     # fallback
     return '.png'
 
 
-def download_icon(session: requests.Session, item: dict, outdir: Path, timeout: int = DEFAULT_TIMEOUT) -> Tuple[bool, str, int]:
+def write_json_atomic(path: Path, obj) -> None:
     """
-    Скачивает и сохраняет иконку.
-    Возвращает (ok: bool, info: str (path or error), index)
+    Записывает obj как JSON во временный файл рядом с path, сбрасывает его на диск
+    (fsync) и атомарно подменяет path через os.replace.
     """
-    title = (item.get('title') or '').strip()
-    url = (item.get('url') or '').strip()
-    icon_url = (item.get('icon') or '').strip()
+    tmp_path = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(obj, option=JSON_OPTIONS))
+        f.flush()
+        os.fsync(f.fileno())
+    # временный файл в том же каталоге — это всегда простой rename, без копирования
+    os.replace(tmp_path, path)
 
-    if not icon_url:
-        return False, 'no_icon_url', -1
 
-    # базовое имя: title или hostname или "bookmark"
-    base_name = title or (urlparse(url).hostname or 'bookmark')
-    base_name = safe_filename_unicode(base_name)
+def decode_data_uri(uri: str) -> Tuple[str, bytes]:
+    """
+    Разбирает data:-URI (data:[<mime>][;base64],<данные>).
+    Возвращает (mime в нижнем регистре, байты). Без MIME-типа по RFC 2397
+    это text/plain. При отсутствии запятой или битом base64 — ValueError.
+    """
+    header, sep, payload = uri.partition(',')
+    if not sep:
+        raise ValueError('missing comma')
+    params = header[5:].split(';')
+    mime = params[0].strip().lower() or 'text/plain'
+    if 'base64' in (p.strip().lower() for p in params[1:]):
+        body = base64.b64decode(unquote(payload))
+    else:
+        body = unquote_to_bytes(payload)
+    return mime, body
+
+
+def load_cache(outdir: Path) -> Dict[str, dict]:
+    """
+    Читает кэш загрузок из outdir/CACHE_FILENAME.
+    Формат: {icon_url: {"path": ..., "etag": ..., "last_modified": ...}}.
+    Повреждённый или отсутствующий кэш — пустой словарь; записи не того
+    формата (например, после ручной правки файла) отбрасываются.
+    """
+    try:
+        cache = orjson.loads((outdir / CACHE_FILENAME).read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    valid = {}
+    for icon_url, entry in cache.items():
+        if not isinstance(entry, dict) or not isinstance(entry.get('path'), str):
+            continue
+        valid[icon_url] = {
+            'path': entry['path'],
+            'etag': entry['etag'] if isinstance(entry.get('etag'), str) else None,
+            'last_modified': entry['last_modified'] if isinstance(entry.get('last_modified'), str) else None,
+        }
+    return valid
+
 
-    headers = {'User-Agent': 'Mozilla/5.0 (compatible; fetch-icons/1.0)'}
+def save_cache(outdir: Path, cache: Dict[str, dict]) -> None:
+    """Сохраняет кэш загрузок (см. write_json_atomic)."""
+    write_json_atomic(outdir / CACHE_FILENAME, cache)
+
+
+def acquire_buf() -> bytearray:
+    """Берёт буфер из пула или создаёт новый размером ICON_BUF_SIZE."""
     try:
-        resp = session.get(icon_url, headers=headers, timeout=timeout, allow_redirects=True, stream=True)
-    except Exception as e:
-        return False, f'error:{e}', -1
+        return _BUF_POOL.get_nowait()
+    except queue.Empty:
+        return bytearray(ICON_BUF_SIZE)
+
 
-    if resp.status_code != 200:
-        return False, f'http_{resp.status_code}', -1
+def release_buf(buf: bytearray) -> None:
+    """Возвращает буфер в пул; слишком разросшиеся буферы не сохраняются."""
+    if len(buf) <= MAX_POOLED_BUF:
+        _BUF_POOL.put_nowait(buf)
 
-    # определяем расширение
-    ext = choose_extension(resp, icon_url)
-    filename = f"{base_name}{ext}"
-    filepath = outdir / filename
-    idx = 1
-    # Если такой файл существует — добавим индекс
-    while filepath.exists():
-        filename = f"{base_name}_{idx}{ext}"
-        filepath = outdir / filename
-        idx += 1
 
+async def read_body(resp: aiohttp.ClientResponse, buf: bytearray, limit: int = MAX_ICON_BYTES) -> int:
+    """
+    Читает тело ответа в buf (увеличивая его удвоением при необходимости).
+    Данные забираются блоками того размера, в каком они уже накоплены в
+    буфере соединения (iter_any), а не нарезаются на мелкие порции.
+    Возвращает число прочитанных байт или -1, если тело больше limit
+    (чтение при этом прерывается).
+    """
+    # если размер известен заранее — расширяем буфер один раз, без удвоений
+    if resp.content_length and resp.content_length > len(buf):
+        buf.extend(bytes(resp.content_length - len(buf)))
+    pos = 0
+    async for chunk in resp.content.iter_any():
+        end = pos + len(chunk)
+        if end > limit:
+            return -1
+        if end > len(buf):
+            buf.extend(bytes(max(len(buf), end - len(buf))))
+        buf[pos:end] = chunk
+        pos = end
+    return pos
+
+
+def write_file(filepath: str, data: Union[bytes, memoryview]) -> None:
+    """
+    Записывает data в новый файл напрямую через os.open/os.write, без буферизованного
+    файлового объекта: для маленькой иконки это open + один write + close.
+    Файл создаётся с O_EXCL: если он уже существует, будет FileExistsError.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    fd = os.open(filepath, flags, 0o644)
+    try:
+        view = memoryview(data)
+        # os.write может записать не всё за раз — дописываем остаток
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+
+def claim_filename(claimed: Set[str], name_lock: threading.Lock, base_name: str, ext: str) -> str:
+    """
+    Выбирает свободное имя base_name[_N]ext по множеству уже занятых имён
+    (без обращения к ФС) и сразу помечает его занятым.
+    """
+    with name_lock:
+        filename = f"{base_name}{ext}"
+        idx = 1
+        # Если такое имя уже занято — добавим индекс
+        while filename in claimed:
+            filename = f"{base_name}_{idx}{ext}"
+            idx += 1
+        claimed.add(filename)
+    return filename
+
+
+def write_unique(body: Union[bytes, memoryview], resolved_dir: str, base_name: str, ext: str, claimed: Set[str], name_lock: threading.Lock) -> str:
+    """
+    Записывает body в файл со свободным именем на основе base_name в resolved_dir
+    (уже абсолютный путь без симлинков) и возвращает полный путь к файлу.
+    """
+    while True:
+        filepath = os.path.join(resolved_dir, claim_filename(claimed, name_lock, base_name, ext))
+        try:
+            write_file(filepath, body)
+            return filepath
+        except FileExistsError:
+            # файл появился в outdir в обход claimed (например, другой процесс) — берём следующее имя
+            continue
+
+
+def save_icon(body: Union[bytes, memoryview], resolved_dir: str, base_name: str, ext: str, claimed: Set[str], name_lock: threading.Lock) -> Tuple[bool, str, int]:
+    """
+    Записывает уже скачанное тело иконки на диск (см. write_file).
+    Сначала пробует юникодное имя, при ошибке ФС — ASCII-fallback.
+    Возвращает (ok: bool, info: str (path or error), index)
+    """
     # Запись в файл: пробуем сохранить с юникодным именем
     try:
-        with open(filepath, 'wb') as f:
-            for chunk in resp.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-        return True, str(filepath.resolve()), -1
-    except OSError as e:
+        filepath = write_unique(body, resolved_dir, base_name, ext, claimed, name_lock)
+        return True, filepath, -1
+    except OSError:
         # Падение может быть из-за недопустимых символов в имени на некоторой ФС.
         # Попробуем сделать ASCII-fallback имя
         ascii_base = ascii_fallback_name(base_name)
-        filename2 = f"{ascii_base}{ext}"
-        filepath2 = outdir / filename2
-        idx2 = 1
-        while filepath2.exists():
-            filename2 = f"{ascii_base}_{idx2}{ext}"
-            filepath2 = outdir / filename2
-            idx2 += 1
         try:
-            with open(filepath2, 'wb') as f:
-                for chunk in resp.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            return True, str(filepath2.resolve()), -1
+            filepath2 = write_unique(body, resolved_dir, ascii_base, ext, claimed, name_lock)
+            return True, filepath2, -1
         except Exception as e2:
             return False, f'write_error:{e2}', -1
     except Exception as e:
         return False, f'error:{e}', -1
 
 
-def process_all(input_path: Path, outdir: Path, backup: bool = True, workers: int = MAX_WORKERS, timeout: int = DEFAULT_TIMEOUT, write_relative: bool = False) -> None:
+async def download_icon(session: aiohttp.ClientSession, title: str, url: str, icon_url: str, resolved_dir: str, sem: asyncio.Semaphore, host_sems: Dict[str, asyncio.Semaphore], cache: Dict[str, dict], claimed: Set[str], name_lock: threading.Lock) -> Tuple[bool, str, int]:
+    """
+    Скачивает и сохраняет иконку.
+    User-Agent и таймаут заданы на уровне session (см. download_all).
+    Если иконка уже есть в кэше, делает условный запрос (If-None-Match /
+    If-Modified-Since) и при 304 возвращает ранее сохранённый файл.
+    title, url, icon_url уже очищены от пробелов (см. process_all).
+    Возвращает (ok: bool, info: str (path or error), index)
+    """
+    if not icon_url:
+        return False, 'no_icon_url', -1
+
+    # базовое имя: title или hostname или "bookmark"
+    base_name = title or (urlparse(url).hostname or 'bookmark')
+    base_name = safe_filename_unicode(base_name)
+
+    # data:-URI: иконка уже внутри ссылки — декодируем и пишем без сети
+    if icon_url[:5].lower() == 'data:':
+        try:
+            ct, body = decode_data_uri(icon_url)
+        except ValueError as e:
+            return False, f'bad_data_uri:{e}', -1
+        if not (ct.startswith('image/') or ct in GENERIC_CONTENT_TYPES):
+            return False, f'bad_ctype:{ct}', -1
+        if not body:
+            return False, 'empty_body', -1
+        if len(body) > MAX_ICON_BYTES:
+            return False, 'too_large', -1
+        return await asyncio.to_thread(save_icon, body, resolved_dir, base_name, CONTENT_TYPE_EXT.get(ct, '.png'), claimed, name_lock)
+
+    # свои заголовки нужны только для условного запроса — иначе запрос идёт с заголовками сессии
+    headers = {}
+    # записи с пропавшими файлами уже отброшены в process_all
+    cached = cache.get(icon_url)
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    # сначала ждём очереди к своему хосту, и только потом занимаем общий слот:
+    # иначе запросы к одному перегруженному хосту держали бы слоты остальных
+    host_sem = host_sems[url_host(icon_url)]
+    async with host_sem, sem:
+        buf = acquire_buf()
+        try:
+            async with session.get(icon_url, headers=headers or None, allow_redirects=True) as resp:
+                if resp.status == 304 and cached:
+                    return True, cached['path'], -1
+                if resp.status != 200:
+                    return False, f'http_{resp.status}', -1
+
+                # отбрасываем не-картинки (например, HTML-страницу ошибки вместо /favicon.ico)
+                # и слишком большие ответы — ещё до чтения тела
+                ct = content_type(resp)
+                if not (ct.startswith('image/') or ct in GENERIC_CONTENT_TYPES):
+                    return False, f'bad_ctype:{ct}', -1
+                if resp.content_length and resp.content_length > MAX_ICON_BYTES:
+                    return False, 'too_large', -1
+
+                # определяем расширение
+                ext = choose_extension(ct, icon_url)
+                etag = resp.headers.get('ETag')
+                last_modified = resp.headers.get('Last-Modified')
+                # читаем тело целиком в буфер из пула: иконки маленькие, и файл затем пишется одним write
+                size = await read_body(resp, buf)
+                if size < 0:
+                    return False, 'too_large', -1
+
+            # соединение уже возвращено в пул keep-alive и может обслуживать
+            # следующий запрос, пока эта иконка пишется на диск.
+            # Запись — в пуле потоков по умолчанию, чтобы не блокировать event loop.
+            # view освобождаем явно: ссылка на него может ещё жить в задаче executor'а,
+            # а пока буфер экспортирован, следующий владелец не сможет его расширить
+            with memoryview(buf)[:size] as view:
+                ok, info, idx = await asyncio.to_thread(save_icon, view, resolved_dir, base_name, ext, claimed, name_lock)
+            if ok and (etag or last_modified):
+                cache[icon_url] = {'path': info, 'etag': etag, 'last_modified': last_modified}
+            return ok, info, idx
+        except asyncio.TimeoutError:
+            return False, 'error:timeout', -1
+        except Exception as e:
+            return False, f'error:{e}', -1
+        finally:
+            release_buf(buf)
+
+
+def interleave_by_host(tasks: List[IconTask]) -> List[IconTask]:
+    """
+    Переупорядочивает задачи round-robin по хостам иконок: сначала по одной
+    задаче на каждый хост, затем по второй и т.д. Так общий лимит загрузок
+    не забивается запросами к одному хосту (их всё равно ограничивает
+    per_host), а соединения к каждому хосту переиспользуются через keep-alive.
+    """
+    groups: Dict[str, List[IconTask]] = {}
+    for task in tasks:
+        host = url_host(task[3])
+        groups.setdefault(host, []).append(task)
+    ordered = []
+    for batch in itertools.zip_longest(*groups.values()):
+        ordered.extend(task for task in batch if task is not None)
+    return ordered
+
+
+async def download_all(tasks: List[IconTask], resolved_dir: str, cache: Dict[str, dict], workers: int = MAX_WORKERS, per_host: int = MAX_PER_HOST, timeout: int = DEFAULT_TIMEOUT) -> List[Tuple[int, bool, str]]:
+    """
+    Скачивает иконки для всех задач (index, title, url, icon_url) в одном event loop.
+    Возвращает список (index, ok, info) в порядке завершения загрузок.
+    """
+    # Semaphore(0) никогда не даст слот, а TCPConnector(limit=0) означает «без лимита» —
+    # без этих проверок запуск с --workers 0 / --per-host 0 просто зависнет
+    if workers < 1:
+        raise ValueError("workers must be greater than 0")
+    if per_host < 1:
+        raise ValueError("per_host must be greater than 0")
+    sem = asyncio.Semaphore(workers)
+    host_sems: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(per_host))
+    # имена, уже занятые в каталоге иконок: новые имена выбираются по этому множеству, без stat() на каждую попытку
+    claimed = set(os.listdir(resolved_dir))
+    name_lock = threading.Lock()
+    connector = aiohttp.TCPConnector(limit=workers, limit_per_host=per_host, ttl_dns_cache=DNS_CACHE_TTL, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    results = []
+
+    async def run(idx: int, title: str, url: str, icon_url: str) -> Tuple[int, bool, str]:
+        try:
+            ok, info, _ = await download_icon(session, title, url, icon_url, resolved_dir, sem, host_sems, cache, claimed, name_lock)
+            return idx, ok, info
+        except Exception as e:
+            return idx, False, f'exception:{e}'
+
+    # общие для всех запросов заголовки и таймаут задаются один раз на сессию,
+    # а не собираются заново для каждой иконки
+    session_headers = {'User-Agent': USER_AGENT}
+    session_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, headers=session_headers, timeout=session_timeout) as session:
+        coros = [run(*task) for task in interleave_by_host(tasks)]
+        for fut in tqdm(asyncio.as_completed(coros), total=len(coros), desc="Downloading icons"):
+            results.append(await fut)
+    return results
+
+
+def process_all(input_path: Path, outdir: Path, backup: bool = True, workers: int = MAX_WORKERS, per_host: int = MAX_PER_HOST, timeout: int = DEFAULT_TIMEOUT, write_relative: bool = False) -> None:
     """
     Главная функция:
     - читает JSON
@@ -205,8 +509,7 @@ def process_all(input_path: Path, outdir: Path, backup: bool = True, workers: in
     outdir.mkdir(parents=True, exist_ok=True)
 
     # читаем JSON
-    with open(input_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    data = orjson.loads(input_path.read_bytes())
 
     if not isinstance(data, list):
         raise ValueError("Input JSON must be an array of bookmark objects")
@@ -217,46 +520,64 @@ def process_all(input_path: Path, outdir: Path, backup: bool = True, workers: in
         shutil.copy2(input_path, bak)
         print(f"[INFO] Backup created: {bak}")
 
-    session = requests.Session()
     results = []  # list of tuples (index, ok, info)
 
-    # Подготовим список задач: сохраняем индексы для привязки результатов
-    tasks = []
+    # Подготовим список задач: сохраняем индексы для привязки результатов.
+    # Строки очищаются здесь один раз, в загрузчик уходят готовые title/url/icon_url.
+    # Одинаковые icon_url скачиваются один раз, результат раздаётся всем закладкам.
+    tasks: List[IconTask] = []
+    first_idx: Dict[str, int] = {}         # icon_url -> индекс закладки, для которой качаем
+    same_icon: Dict[int, List[int]] = {}   # этот индекс -> все закладки с тем же icon_url
     for i, item in enumerate(data):
         icon_url = (item.get('icon') or '').strip()
         if not icon_url:
             # пропускаем — пометим сразу
             results.append((i, False, 'no_icon_url'))
             continue
-        tasks.append((i, item))
+        if not icon_url.lower().startswith(REMOTE_ICON_PREFIXES):
+            # уже локальный путь (например, повторный запуск по обработанному JSON) — не трогаем
+            results.append((i, False, 'already_local'))
+            continue
+        if icon_url in first_idx:
+            same_icon[first_idx[icon_url]].append(i)
+            continue
+        first_idx[icon_url] = i
+        same_icon[i] = [i]
+        tasks.append((i, (item.get('title') or '').strip(), (item.get('url') or '').strip(), icon_url))
 
-    # Скачиваем параллельно
+    # Скачиваем параллельно (asyncio); если качать нечего — не создаём ни event loop, ни сессию
     if tasks:
-        with ThreadPoolExecutor(max_workers=workers) as exe:
-            futures = {exe.submit(download_icon, session, item, outdir, timeout): idx for idx, item in tasks}
-            for fut in tqdm(as_completed(futures), total=len(futures), desc="Downloading icons"):
-                idx = futures[fut]
-                try:
-                    ok, info, _ = fut.result()
-                    results.append((idx, ok, info))
-                except Exception as e:
-                    results.append((idx, False, f'exception:{e}'))
+        # каталог разрешается один раз; пути к иконкам дальше собираются простой склейкой строк
+        resolved_dir = str(outdir.resolve())
+        cache = load_cache(outdir)
+        # файлы из кэша проверяем здесь, один раз, а не stat() в каждой корутине на event loop
+        for _, _, _, icon_url in tasks:
+            cached = cache.get(icon_url)
+            if cached and not os.path.exists(cached['path']):
+                del cache[icon_url]
+        downloaded = asyncio.run(download_all(tasks, resolved_dir, cache, workers=workers, per_host=per_host, timeout=timeout))
+        save_cache(outdir, cache)
+        for idx, ok, info in downloaded:
+            for i in same_icon[idx]:
+                results.append((i, ok, info))
 
     # применяем результаты: если ok — заменяем data[idx]['icon'] на локальный путь (либо относительный)
     success_count = 0
     fail_count = 0
+    local_count = 0
+    # префикс директории с JSON (с завершающим разделителем) для относительных путей:
+    # обычная проверка строки вместо Path.relative_to на каждую иконку
+    base = os.path.join(str(input_path.parent), '')
     for idx, ok, info in results:
         if ok:
             success_count += 1
-            if write_relative:
+            if write_relative and info.startswith(base):
                 # относительный путь от директории с JSON
-                try:
-                    rel = Path(info).relative_to(input_path.parent)
-                    data[idx]['icon'] = str(rel)
-                except Exception:
-                    data[idx]['icon'] = str(info)
+                data[idx]['icon'] = info[len(base):]
             else:
-                data[idx]['icon'] = str(info)
+                data[idx]['icon'] = info
+        elif info == 'already_local':
+            local_count += 1
         else:
             fail_count += 1
             # оставляем прежний icon (не затираем)
@@ -264,12 +585,9 @@ def process_all(input_path: Path, outdir: Path, backup: bool = True, workers: in
             pass
 
     # пишем во временный файл, затем атомарно заменяем
-    tmp_path = input_path.with_suffix(input_path.suffix + '.tmp')
-    with open(tmp_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    shutil.move(str(tmp_path), str(input_path))
+    write_json_atomic(input_path, data)
 
-    print(f"[DONE] Success: {success_count}, Fail: {fail_count}. JSON updated: {input_path}")
+    print(f"[DONE] Success: {success_count}, Fail: {fail_count}, Already local: {local_count}. JSON updated: {input_path}")
 
 
 def main():
@@ -277,7 +595,8 @@ def main():
     parser.add_argument('--input', '-i', required=True, help='path to bookmarks.json (export file)')
     parser.add_argument('--outdir', '-o', required=True, help='output directory where to save icons (absolute preferred)')
     parser.add_argument('--no-backup', dest='backup', action='store_false', help='do not create a .bak backup')
-    parser.add_argument('--workers', '-w', type=int, default=MAX_WORKERS, help='concurrent download threads')
+    parser.add_argument('--workers', '-w', type=int, default=MAX_WORKERS, help='concurrent downloads')
+    parser.add_argument('--per-host', type=int, default=MAX_PER_HOST, help='concurrent downloads from a single host')
     parser.add_argument('--timeout', type=int, default=DEFAULT_TIMEOUT, help='HTTP timeout seconds per request')
     parser.add_argument('--relative', dest='relative', action='store_true', help='store relative paths in JSON (relative to JSON file location)')
     args = parser.parse_args()
@@ -286,7 +605,7 @@ def main():
     outdir = Path(args.outdir).expanduser().resolve()
 
     try:
-        process_all(input_path=input_path, outdir=outdir, backup=args.backup, workers=args.workers, timeout=args.timeout, write_relative=args.relative)
+        process_all(input_path=input_path, outdir=outdir, backup=args.backup, workers=args.workers, per_host=args.per_host, timeout=args.timeout, write_relative=args.relative)
     except Exception as e:
         print(f"[ERROR] {e}", file=sys.stderr)
         sys.exit(2)